@@ -1,7 +1,49 @@
 import sys
 import time
-from contextlib import contextmanager, redirect_stdout, redirect_stderr
-from typing import List, Union, Any, Dict
+from contextlib import contextmanager
+from typing import Callable, Iterable, List, Union, Any, Dict
+
+
+class _Part:
+    """
+    Output of a single type that hasn't been flushed yet.
+    The text is kept as a list of chunks which is only joined when needed,
+    since repeatedly concatenating strings can be quadratic.
+    Supports item access like the dicts passed to the flush function,
+    e.g. part["text"], for code such as should_flush overrides that inspects OutputBuffer.parts.
+    """
+    __slots__ = ("type", "chunks", "extra")
+
+    def __init__(self, output_type: str, extra: Dict[str, Any]):
+        self.type = output_type
+        self.chunks: List[str] = []
+        self.extra = extra
+
+    @property
+    def text(self) -> str:
+        chunks = self.chunks
+        if len(chunks) != 1:
+            # Keep the joined text so that it isn't joined again next time
+            chunks[:] = ["".join(chunks)]
+        return chunks[0]
+
+    def __getitem__(self, key: str) -> Any:
+        if key == "type":
+            return self.type
+        if key == "text":
+            return self.text
+        return self.extra[key]
+
+    def __setitem__(self, key: str, value: Any):
+        if key == "type":
+            self.type = value
+        elif key == "text":
+            self.chunks[:] = [value]
+        else:
+            self.extra[key] = value
+
+    def serialize(self) -> Dict[str, Any]:
+        return dict(type=self.type, text=self.text, **self.extra)
 
 
 class OutputBuffer:
@@ -18,8 +60,12 @@ class OutputBuffer:
         self.reset()
 
     def reset(self):
-        self.parts: List[Dict[str, Any]] = []
-        self.last_time = time.time()
+        # Pending output. Parts can be read like the dicts passed to the flush function.
+        self.parts: List[_Part] = []
+        self._total_len = 0  # combined length of the chunks in all parts
+        # monotonic() can't jump backwards like time(),
+        # and precomputing the deadline saves arithmetic on every put().
+        self.flush_deadline = time.monotonic() + self.flush_time
 
     def put(self, output_type: str, text: Union[str, bytes], **extra):
         """
@@ -29,38 +75,95 @@ class OutputBuffer:
         :param extra: any other information to include in the output event
         """
 
+        text = self._check_text(text)
+        self._part_for(output_type, extra).chunks.append(text)
+        self._total_len += len(text)
+
+        if self.should_flush():
+            self.flush()
+
+    def extend(self, output_type: str, texts: Iterable[Union[str, bytes]]):
+        """
+        Equivalent to calling put(output_type, text) for each of the given texts,
+        but only checks whether to flush once at the end.
+        """
+        if type(self).put is not OutputBuffer.put:
+            # Respect an overridden put()
+            for text in texts:
+                self.put(output_type, text)
+            return
+
+        texts = [self._check_text(text) for text in texts]
+        if not texts:
+            return
+
+        self._part_for(output_type, {}).chunks.extend(texts)
+        self._total_len += sum(map(len, texts))
+
+        if self.should_flush():
+            self.flush()
+
+    @staticmethod
+    def _check_text(text: Union[str, bytes]) -> str:
         if isinstance(text, bytes):
             text = text.decode("utf8", "replace")
         if not isinstance(text, str):
             raise TypeError(f"Can only write str, not {type(text).__name__}")
+        return text
+
+    def _part_for(self, output_type: str, extra: Dict[str, Any]) -> _Part:
+        """
+        Returns the part that output of the given type should be appended to:
+        the last part if it has the same type and there's no extra data,
+        otherwise a newly started part.
+        """
         assert isinstance(output_type, str)
 
-        if self.parts and self.parts[-1]["type"] == output_type and not extra:
-            self.parts[-1]["text"] += text
-        else:
-            self.parts.append(dict(type=output_type, text=text, **extra))
+        parts = self.parts
+        if parts and parts[-1].type == output_type and not extra:
+            return parts[-1]
 
-        if self.should_flush():
-            self.flush()
+        part = _Part(output_type, extra)
+        parts.append(part)
+        return part
+
+    def _make_put(self, output_type: str) -> Callable[[Union[str, bytes]], None]:
+        """
+        Returns a function equivalent to put() with a fixed output_type and no extra data,
+        used as SysStream.write which is called several times for every print().
+        It appends directly to the last part if possible, otherwise falls back to put().
+        """
+        def put(text: Union[str, bytes]):
+            parts = self.parts
+            if parts and parts[-1].type == output_type and type(text) is str:
+                parts[-1].chunks.append(text)
+                self._total_len += len(text)
+                if self.should_flush():
+                    self.flush()
+                return
+            self.put(output_type, text)
+
+        return put
 
     def should_flush(self) -> bool:
         """
         Determines whether flush() should be called after a call to put().
         By default, returns True if any of these are true:
         - There are multiple parts (which typically means multiple different part types)
-        - It's been at least a second since the last flush
         - The combined length of all the 'text' values is at least 1000 characters
+        - It's been at least a second since the last flush
+        The clock is only read if the cheaper checks fail.
         """
         return (
             len(self.parts) > 1
-            or self.last_time and time.time() - self.last_time > self.flush_time
-            or sum(len(p["text"]) for p in self.parts) >= self.flush_length
+            or self._total_len >= self.flush_length
+            or time.monotonic() > self.flush_deadline
         )
 
     def flush(self):
         if not self.parts:
             return
-        self._flush(self.parts)
+        self._flush([part.serialize() for part in self.parts])
         self.reset()
 
     @contextmanager
@@ -69,9 +172,15 @@ class OutputBuffer:
         Context manager to temporarily replace sys.stdout and sys.stderr
         with SysStream objects that write to this buffer.
         """
-        with redirect_stdout(SysStream("stdout", self)):  # noqa
-            with redirect_stderr(SysStream("stderr", self)):  # noqa
-                yield
+        # Swapping both directly is cheaper than nesting
+        # contextlib.redirect_stdout and redirect_stderr on every run.
+        # The streams are new each time so that changes made to them by user code don't persist.
+        original = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = SysStream("stdout", self), SysStream("stderr", self)  # noqa
+        try:
+            yield
+        finally:
+            sys.stdout, sys.stderr = original
 
 
 class SysStream:
@@ -81,12 +190,30 @@ class SysStream:
     def __init__(self, output_type: str, output_buffer: OutputBuffer):
         self.type = output_type
         self.output_buffer = output_buffer
+        if type(self).write is SysStream.write and type(output_buffer).put is OutputBuffer.put:
+            # An instance attribute rather than a method to save a call on every write.
+            # Only when neither write() nor put() is overridden, since it bypasses both.
+            self.write = output_buffer._make_put(output_type)  # type: ignore
+        self._original = sys.__stdout__ if output_type == "stdout" else sys.__stderr__
+        # Copy attributes commonly probed by print() and libraries
+        # so that accessing them doesn't go through __getattr__
+        for name in ("encoding", "errors", "buffer", "mode", "closed", "name", "isatty", "fileno"):
+            try:
+                setattr(self, name, getattr(self._original, name))
+            except AttributeError:  # pragma: no cover
+                pass
 
     def __getattr__(self, item: str):
-        return getattr(sys.__stdout__, item)
+        if item == "_original":
+            # Not set yet, e.g. while copying, which would otherwise recurse forever
+            raise AttributeError(item)
+        return getattr(self._original, item)
 
     def write(self, s: Union[str, bytes]):
         self.output_buffer.put(self.type, s)
 
+    def writelines(self, lines: Iterable[Union[str, bytes]]):
+        self.output_buffer.extend(self.type, lines)
+
     def flush(self):
         self.output_buffer.flush()
@@ -6,20 +6,77 @@ import os
 import sys
 import time
 import traceback
-from code import InteractiveConsole
 from collections.abc import Awaitable
 from contextlib import contextmanager
+from functools import lru_cache
 from types import CodeType, ModuleType, TracebackType
-from typing import Callable, Any, Dict, Optional, Union
+from typing import TYPE_CHECKING, Callable, Any, Dict, Optional, Tuple, Union
 
 from .output import OutputBuffer
 
+if TYPE_CHECKING:
+    from code import InteractiveConsole
+
 log = logging.getLogger(__name__)
 
 
 Callback = Callable[[str, Dict[str, Any]], Any]
 
 
+_TOP_LEVEL_AWAIT_FLAG = ast.PyCF_ALLOW_TOP_LEVEL_AWAIT
+
+@lru_cache(maxsize=128)
+def _compile_cached(
+    source_code: str, filename: str, mode: str, flags: int
+) -> Tuple[Optional[CodeType], Optional[Tuple[type, tuple]]]:
+    """
+    Compiles source_code, returning either a code object
+    or the type and args of the SyntaxError (or subclass) raised.
+    Results are cached so that repeatedly running the same code doesn't recompile it.
+    Only the args are cached, not the exception itself,
+    so that each run gets a new exception that it can modify freely.
+    """
+    try:
+        return compile(source_code, filename, mode, flags=flags), None
+    except SyntaxError as e:
+        return None, (type(e), e.args)
+
+
+def _is_only_comments(source_code: str) -> bool:
+    """
+    Returns True if source_code has nothing but comments and whitespace.
+    Much cheaper than checking whether ast.parse(source_code).body is empty.
+    Only the whitespace and line breaks that Python's tokenizer accepts count,
+    so e.g. a line with a non-breaking space is left for compile() to report.
+    """
+    # Most code doesn't start with a comment, so check that before splitting into lines
+    stripped = source_code.lstrip(" \t\f\r\n")
+    if stripped and not stripped.startswith("#"):
+        return False
+    # Null bytes are an error even in comments
+    if "\0" in stripped:
+        return False
+    for line in stripped.replace("\r", "\n").split("\n"):
+        line = line.strip(" \t\f")
+        if line and not line.startswith("#"):
+            return False
+    return True
+
+
+def _file_state(filename: str) -> Optional[Tuple[int, int]]:
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+# Maps filenames to the source code last written there by any runner
+# and the _file_state just after writing it, so that rerunning the same code
+# doesn't rewrite the same file unless something else has changed it since.
+_written_sources: Dict[str, Tuple[str, Optional[Tuple[int, int]]]] = {}
+
+
 class Runner:
     OutputBufferClass = OutputBuffer
 
@@ -32,33 +89,113 @@ class Runner:
     ):
         self.set_callback(callback)  # type: ignore
         self.set_filename(filename)
+        self._linecache_source: Optional[str] = None
+        self._linecache_entry: Optional[tuple] = None
         self.set_source_code(source_code)
-        self.console = InteractiveConsole()
+        self._console: Optional["InteractiveConsole"] = None
+        self.globals_dict = {}
+        self._snoop_config_cache: Dict[frozenset, Any] = {}  # see snoop.get_config
         self.output_buffer = self.OutputBufferClass(
             lambda parts: self.callback("output", parts=parts)
         )
+        # Bound once since output() and callback() are called a lot
+        self._put = self.output_buffer.put
+        self._flush = self.output_buffer.flush
         self.reset()
 
+    @property
+    def console(self):
+        """
+        A `code.InteractiveConsole` whose `locals` are the globals of the running code,
+        i.e. the same as `globals_dict`, including when assigned.
+        Kept for backwards compatibility, use `globals_dict` instead.
+        """
+        if self._console is None:
+            from code import InteractiveConsole
+
+            self._console = InteractiveConsole(self._globals_dict)
+        return self._console
+
+    @console.setter
+    def console(self, console: "InteractiveConsole"):
+        # The new console's locals become the globals, as when console was a plain attribute
+        self._globals_dict = console.locals  # type: ignore
+        self._console = console
+
+    @property
+    def globals_dict(self) -> Dict[str, Any]:
+        """
+        The globals that code is executed in, replaced by reset().
+        """
+        # console.locals may have been assigned directly
+        console = self._console
+        if console is not None:
+            return console.locals  # type: ignore
+        return self._globals_dict
+
+    @globals_dict.setter
+    def globals_dict(self, value: Dict[str, Any]):
+        self._globals_dict = value
+        if self._console is not None:
+            self._console.locals = value
+
     def set_callback(self, callback: Callback):
         self._callback = callback
 
     def set_filename(self, filename: str):
-        self.filename = os.path.normcase(os.path.abspath(filename))
+        # Interned so that it's usually the same object as the co_filename of compiled code,
+        # making comparisons in skip_traceback_internals quick.
+        self.filename = sys.intern(os.path.normcase(os.path.abspath(filename)))
+        # The initial globals of the __main__ module, copied by reset()
+        self._locals_template = {
+            "__name__": "__main__",
+            "__doc__": None,
+            "__package__": None,
+            "__loader__": None,
+            "__spec__": None,
+            "__file__": self.filename,
+            "__builtins__": builtins.__dict__,
+        }
 
     def set_source_code(self, source_code: str):
         self.source_code = source_code
         # Write to file if permitted by system
-        try:
-            with open(self.filename, "w") as f:
-                f.write(self.source_code)
-        except:  # pragma: no cover
-            pass 
-        linecache.cache[self.filename] = (
-            len(self.source_code),
-            0,
-            [line + "\n" for line in self.source_code.splitlines()],
-            self.filename,
+        written = False
+        state = _file_state(self.filename)
+        file_has_source = (
+            state is not None
+            and _written_sources.get(self.filename) == (source_code, state)
         )
+        if not file_has_source:
+            try:
+                with open(self.filename, "w") as f:
+                    f.write(self.source_code)
+                _written_sources[self.filename] = (source_code, _file_state(self.filename))
+                written = file_has_source = True
+            except:
+                pass
+
+        # Reuse the existing linecache entry if it's still there and has the same source.
+        # It may have been removed since, e.g. by linecache.checkcache when formatting a traceback.
+        entry = linecache.cache.get(self.filename)
+        if entry is not None and (
+            (source_code == self._linecache_source and entry is self._linecache_entry)
+            # linecache replaces our lazy entry with one read from the file
+            # the first time it's needed. If the file still holds this source,
+            # that entry is already split into lines and checkcache keeps it honest.
+            or (
+                not written
+                and file_has_source
+                and len(entry) == 4
+                and entry[1] is not None
+            )
+        ):
+            return
+        # A 'lazy' linecache entry: the source is only split into lines
+        # when something like a traceback, inspect or pdb actually needs it,
+        # and only if the file written above can't be read instead.
+        self._linecache_source = source_code
+        self._linecache_entry = linecache.cache[self.filename] = (lambda: source_code,)
 
     def callback(self, event_type: str, **data):
         """
@@ -67,7 +204,7 @@ class Runner:
         may be called with an output event before this one.
         """
         if event_type != "output":
-            self.output_buffer.flush()
+            self._flush()
 
         return self._callback(event_type, data)
 
@@ -76,18 +213,17 @@ class Runner:
         Saves the given output data to eventually (perhaps immediately)
         send it in a callback with event_type 'output'.
         """
-        return self.output_buffer.put(output_type, text, **extra)
+        return self._put(output_type, text, **extra)
 
     def execute(self, code_obj: CodeType, mode: str = None, snoop_config: dict = None):
         """
         Executes a raw code object. This is an internal method, use `run` or `run_async` instead.
         """
         if mode == "snoop":
-            from .snoop import exec_snoop, SnoopStream
-            default_config = dict(columns=(), out=SnoopStream(self.output_buffer), color=False)
-            exec_snoop(self, code_obj, snoop_config={**default_config, **(snoop_config or {})})
+            from .snoop import exec_snoop
+            exec_snoop(self, code_obj, snoop_config=snoop_config)
         else:
-            return eval(code_obj, self.console.locals)  # type: ignore
+            return eval(code_obj, self.globals_dict)  # type: ignore
 
     @contextmanager
     def _execute_context(self):
@@ -143,7 +279,8 @@ class Runner:
         skipping frames from python_runner.
         """
         original = tb
-        while tb and tb.tb_frame.f_code.co_filename != self.filename:
+        filename = self.filename
+        while tb and tb.tb_frame.f_code.co_filename != filename:
             tb = tb.tb_next
         if tb:
             return tb
@@ -182,25 +319,18 @@ class Runner:
 
         self.set_source_code(source_code)
 
-        try:
-            return compile(
-                self.source_code,
-                self.filename,
-                compile_mode,
-                flags=top_level_await * ast.PyCF_ALLOW_TOP_LEVEL_AWAIT,
-            )
-        except SyntaxError as e:
-            try:
-                if not ast.parse(self.source_code).body:
-                    # Code is only comments, which cannot be compiled in 'single' mode
-                    return None
-            except SyntaxError:
-                pass
-
-            e.__traceback__ = None
-            self.output("syntax_error", **self.serialize_syntax_error(e))
+        # There's nothing to run, and code that is only comments
+        # cannot be compiled in 'single' or 'eval' mode anyway.
+        if _is_only_comments(self.source_code):
             return None
 
+        flags = _TOP_LEVEL_AWAIT_FLAG if top_level_await else 0
+        code_obj, error = _compile_cached(self.source_code, self.filename, compile_mode, flags)
+        if error is not None:
+            error_type, error_args = error
+            self.output("syntax_error", **self.serialize_syntax_error(error_type(*error_args)))
+        return code_obj
+
     def post_run(self):
         self.output_buffer.flush()
 
@@ -209,16 +339,24 @@ class Runner:
         Called before running code 'from scratch' (i.e. when `mode` is not 'single' or 'eval')
         to reset state such as global variables.
         """
+        # A new module rather than a cleared one, since functions etc. from earlier runs
+        # may still be in use and need their own globals.
         mod = ModuleType("__main__")
-        mod.__file__ = self.filename
+        mod.__dict__.update(self._locals_template)
         sys.modules["__main__"] = mod
-        self.console.locals = mod.__dict__
+        self.globals_dict = mod.__dict__
         self.output_buffer.reset()
 
 
 class FakeStdin:
     def __init__(self, readline):
         self.readline = readline
+        # Copy commonly used attributes so that accessing them doesn't go through __getattr__
+        for name in ("encoding", "buffer", "fileno", "isatty"):
+            try:
+                setattr(self, name, getattr(sys.__stdin__, name))
+            except AttributeError:  # pragma: no cover
+                pass
 
     def __getattr__(self, item):
         return getattr(sys.__stdin__, item)
@@ -240,24 +378,47 @@ class PatchedStdinRunner(Runner):  # noqa
         super().reset()
         self.line = ""
 
+    @property
+    def line(self) -> str:
+        """
+        The part of the last line of input that hasn't been read yet.
+        """
+        return self._line_buf[self._line_pos:]
+
+    @line.setter
+    def line(self, value: str):
+        # Reading advances _line_pos through _line_buf instead of slicing off
+        # the remainder each time, which would be quadratic in the line length.
+        self._line_buf = value
+        self._line_pos = 0
+
     def non_str_input(self, value: Any):
         raise TypeError(f"Callback for input should return str, not {type(value).__name__}")
 
     def readline(self, n=-1, prompt="") -> str:
-        if not self.line and n:
+        buf = self._line_buf
+        pos = self._line_pos
+        remaining = len(buf) - pos
+        if not remaining and n:
             value = self.callback("input", prompt=prompt)
             if not isinstance(value, str):
                 value = self.non_str_input(value) or ""
             if not value.endswith("\n"):
                 value += "\n"
             self.output("input", value)
-            self.line = value
-
-        if n < 0 or n > len(self.line):
-            n = len(self.line)
-        to_return = self.line[:n]
-        self.line = self.line[n:]
-        return to_return
+            buf = value
+            pos = 0
+            remaining = len(value)
+
+        if n < 0 or n > remaining:
+            n = remaining
+        end = pos + n
+        if n == remaining:
+            self.line = ""
+        else:
+            self._line_buf = buf
+            self._line_pos = end
+        return buf[pos:end]
 
     def input(self, prompt="") -> str:
         self.output("input_prompt", prompt)
@@ -270,8 +431,11 @@ class PatchedSleepRunner(Runner):  # noqa
         return super().pre_run(*args, **kwargs)
 
     def sleep(self, seconds: Union[int, float]):
+        # isinstance rather than an exact type check so that subclasses
+        # like bool and numpy.float64 are accepted, as with time.sleep.
         if not isinstance(seconds, (int, float)):
             raise TypeError(f"an integer is required (got type {type(seconds).__name__})")
+        # Not the same as `seconds < 0`: this also rejects NaN.
         if not seconds >= 0:
             raise ValueError("sleep length must be non-negative")
         return self.callback("sleep", seconds=seconds)
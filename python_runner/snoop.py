@@ -1,7 +1,10 @@
 import ast
 import inspect
 import os
+import threading
+from functools import lru_cache
 from types import CodeType
+from typing import FrozenSet, List, Optional, Tuple
 
 import snoop  # type: ignore
 import snoop.formatting  # type: ignore
@@ -16,6 +19,33 @@ snoop.tracer.internal_directories += (
     internal_dir,
 )
 
+# snoop's cache of Source objects keyed by filename, which must be cleared when the source changes.
+# _class_local stores the dict on the class, so it's the same object every time.
+_source_cache = snoop.formatting.Source._class_local('__source_cache', {})
+
+# The code object currently being run by exec_snoop in this thread
+_current = threading.local()
+
+
+class PatchedFrameInfo(snoop.tracer.FrameInfo):  # pragma: no cover (happens inside snoop's trace function)
+    """
+    Treats the module-level code run by exec_snoop like an IPython cell,
+    so that snoop traces it line by line like a function.
+    Defined once here rather than per call so that the override costs no more than a property.
+    """
+
+    @property
+    def is_ipython_cell(self):
+        return self._is_ipython_cell or self.frame.f_code == getattr(_current, "code_obj", None)
+
+    @is_ipython_cell.setter
+    def is_ipython_cell(self, value):
+        # Set by FrameInfo.__init__
+        self._is_ipython_cell = value
+
+
+snoop.tracer.FrameInfo = PatchedFrameInfo
+
 TYPING = False
 if TYPING:
     from .runner import Runner
@@ -29,33 +59,74 @@ class SnoopStream(SysStream):
         pass  # pragma: no cover
 
 
-def exec_snoop(runner: 'Runner', code_obj: CodeType, snoop_config: dict):
-    class PatchedFrameInfo(snoop.tracer.FrameInfo):  # pragma: no cover (happens inside snoop's trace function)
-        def __init__(self, *args, **kwargs):
-            super().__init__(*args, **kwargs)
-            self.is_ipython_cell = self.frame.f_code == code_obj
+@lru_cache(maxsize=128)
+def find_codes(
+    code_obj: CodeType, source_code: str
+) -> Tuple[FrozenSet[str], Tuple[CodeType, ...]]:
+    """
+    Returns the variable names used in source_code,
+    and code_obj (compiled from source_code) with all the code objects within it.
+    Cached since code objects are immutable and the compile cache means they're often rerun.
+    """
+    # Only names that actually appear in the source, so not e.g. the __module__ and __qualname__
+    # that the compiler adds to class bodies, or names bound only by imports.
+    whitelist = frozenset(
+        node.id
+        for node in ast.walk(ast.parse(source_code))
+        if isinstance(node, ast.Name)
+    )
 
-    snoop.tracer.FrameInfo = PatchedFrameInfo
+    codes: List[CodeType] = []
+    stack = [code_obj]
+    while stack:
+        code = stack.pop()
+        codes.append(code)
+        stack.extend(const for const in code.co_consts if inspect.iscode(const))
 
-    snoop.formatting.Source._class_local('__source_cache', {}).pop(runner.filename, None)
-    config = snoop.Config(**snoop_config)
-    tracer = config.snoop()
-    tracer.variable_whitelist = set()
-    for node in ast.walk(ast.parse(runner.source_code)):
-        if isinstance(node, ast.Name):
-            name = node.id
-            tracer.variable_whitelist.add(name)
-    tracer.target_codes.add(code_obj)
+    return whitelist, tuple(codes)
+
+
+# A file given as `out` is only overwritten by the first write of a config,
+# and the formatter of a config remembers column widths.
+_STATEFUL_OPTIONS = frozenset({"out", "overwrite", "columns", "formatter_class"})
 
-    def find_code(root_code: CodeType):
-        for sub_code_obj in root_code.co_consts:
-            if not inspect.iscode(sub_code_obj):
-                continue
 
-            find_code(sub_code_obj)
-            tracer.target_codes.add(sub_code_obj)
+def get_config(runner: 'Runner', snoop_config: Optional[dict]) -> snoop.Config:
+    """
+    Returns a snoop.Config using the given snoop_config on top of the defaults for the runner.
+    Configs are cached on the runner since creating them isn't cheap,
+    unless snoop_config has options that make the config keep state between runs.
+    """
+    snoop_config = snoop_config or {}
+    key: Optional[frozenset] = None
+    if _STATEFUL_OPTIONS.isdisjoint(snoop_config):
+        try:
+            key = frozenset(snoop_config.items())
+        except TypeError:
+            pass  # unhashable values, e.g. a list of watch expressions
+    if key is not None:
+        config = runner._snoop_config_cache.get(key)
+        if config is not None:
+            return config
 
-    find_code(code_obj)
+    default_config = dict(columns=(), out=SnoopStream(runner.output_buffer), color=False)
+    config = snoop.Config(**{**default_config, **snoop_config})
+    if key is not None:
+        runner._snoop_config_cache[key] = config
+    return config
+
+
+def exec_snoop(runner: 'Runner', code_obj: CodeType, snoop_config: Optional[dict]):
+    _source_cache.pop(runner.filename, None)
+    config = get_config(runner, snoop_config)
+    tracer = config.snoop()
+    tracer.variable_whitelist, target_codes = find_codes(code_obj, runner.source_code)
+    tracer.target_codes.update(target_codes)
 
-    with tracer:
-        runner.execute(code_obj)
+    previous = getattr(_current, "code_obj", None)
+    _current.code_obj = code_obj
+    try:
+        with tracer:
+            runner.execute(code_obj)
+    finally:
+        _current.code_obj = previous
@@ -0,0 +1,68 @@
+import os
+import traceback
+from functools import lru_cache
+
+from python_runner import PatchedStdinRunner
+from python_runner.output import OutputBuffer
+
+
+class MyRunner(PatchedStdinRunner):
+    pass
+
+
+class NoTracebackRunner(MyRunner):
+    def serialize_traceback(self, exc):
+        return {
+            "text": "".join(traceback.format_exception_only(type(exc), exc)),
+        }
+
+
+def default_filename():
+    return os.path.normcase(os.path.abspath("my_program.py"))
+
+
+class EventCollector:
+    """
+    Records the events passed to its callback.
+    Subclasses can override callback to respond differently.
+    """
+
+    __slots__ = ("events",)
+
+    def __init__(self):
+        self.events = []
+
+    def callback(self, event_type, data):
+        self.events.append((event_type, data))
+        if event_type == "input":
+            return f"input: {len(self.events)}"
+
+
+@lru_cache(maxsize=None)
+def default_runner():
+    # Shared by tests that don't need a runner of their own
+    return MyRunner()
+
+
+def check_simple(
+    source_code,
+    expected_events,
+    mode="exec",
+    runner=None,
+    flush_time=OutputBuffer.flush_time,
+    snoop_config=None,
+    collector=None,
+):
+    OutputBuffer.flush_time = flush_time
+
+    collector = collector or EventCollector()
+    if runner is None:
+        runner = default_runner()
+        # Start from a clean slate like a new runner would, even in 'single' and 'eval' modes
+        runner.reset()
+    runner.set_callback(collector.callback)
+    result = runner.run(source_code, mode=mode, snoop_config=snoop_config)
+    assert collector.events == expected_events
+    if mode != "eval":
+        assert result is None
+    return result
@@ -1,76 +1,190 @@
 import asyncio
 import builtins
+import linecache
 import os
 import sys
 import time
-import traceback
-from textwrap import dedent
+from code import InteractiveConsole
+from types import MappingProxyType, SimpleNamespace
 
 import pytest
 
-from python_runner import PatchedStdinRunner, PatchedSleepRunner
+from python_runner import PatchedSleepRunner, output
 from python_runner.output import OutputBuffer
+from tests._helpers import (
+    EventCollector,
+    MyRunner,
+    NoTracebackRunner,
+    check_simple,
+    default_filename,
+)
 
 
-class MyRunner(PatchedStdinRunner):
-    pass
+# Expected events shared by several tests, built once
+EXPECTED_PRINT_12 = [("output", {"parts": [{"type": "stdout", "text": "1\n2\n"}]})]
+EXPECTED_PRINT_3 = [("output", {"parts": [{"type": "stdout", "text": "3\n"}]})]
+EXPECTED_PRINT_HI = [("output", {"parts": [{"type": "stdout", "text": "hi\n"}]})]
 
 
-class NoTracebackRunner(MyRunner):
-    def serialize_traceback(self, exc):
-        return {
-            "text": "".join(traceback.format_exception_only(type(exc), exc)),
-        }
-
-
-events = []
-
-def default_filename():
-    return os.path.normcase(os.path.abspath("my_program.py"))
+MIXED_SRC = """
+import sys
 
-def default_callback(event_type, data):
-    events.append((event_type, data))
-    if event_type == "input":
-        return f"input: {len(events)}"
+print(1)
+print(2)
 
+print(3, file=sys.stderr)
+print(4, file=sys.stderr)
 
-def check_simple(
-    source_code,
-    expected_events,
-    mode="exec",
-    runner=None,
-    flush_time=OutputBuffer.flush_time,
-):
-    OutputBuffer.flush_time = flush_time
+print(5)
+print(6)
 
-    global events
-    events = []
+print(7, file=sys.stderr)
+print(8, file=sys.stderr)
 
-    runner = runner or MyRunner(callback=default_callback)
-    result = runner.run(source_code, mode=mode)
-    assert events == expected_events
-    if mode != "eval":
-        assert result is None
-    return result
+1/0
+"""
 
 
-def test_simple_print():
-    check_simple(
+CASES = [
+    pytest.param(
         "print(1); print(2)",
+        EXPECTED_PRINT_12,
+        id="simple_print",
+    ),
+    pytest.param(
+        MIXED_SRC,
         [
+            (
+                "output",
+                {
+                    "parts": [
+                        {"type": "stdout", "text": "1\n2\n"},
+                        {"type": "stderr", "text": "3"},
+                    ]
+                },
+            ),
+            (
+                "output",
+                {
+                    "parts": [
+                        {"type": "stderr", "text": "\n4\n"},
+                        {"type": "stdout", "text": "5"},
+                    ]
+                },
+            ),
+            (
+                "output",
+                {
+                    "parts": [
+                        {"type": "stdout", "text": "\n6\n"},
+                        {"type": "stderr", "text": "7"},
+                    ]
+                },
+            ),
             (
                 "output",
                 {
                     "parts": [
                         {
-                            "type": "stdout",
-                            "text": "1\n2\n",
+                            "type": "stderr",
+                            "text": "\n8\n",
                         },
-                    ],
+                        {
+                            "type": "traceback",
+                            "text": 'Traceback (most recent call last):\n'
+                                    f'  File "{default_filename()}", line 16, in <module>\n'
+                                    '    1/0\n'
+                                    'ZeroDivisionError: division by zero\n',
+                        },
+                    ]
                 },
             ),
         ],
-    )
+        id="mixed_output",
+    ),
+    pytest.param(
+        "a b",
+        [
+            (
+                "output",
+                {
+                    "parts": [
+                        {
+                            "type": "syntax_error",
+                            "text": f'  File "{default_filename()}", line 1\n'
+                                    "    a b\n"
+                                    "      ^\n"
+                                    "SyntaxError: invalid syntax\n",
+                        }
+                    ]
+                },
+            )
+        ],
+        id="syntax_error",
+    ),
+    pytest.param(
+        "nonexistent",
+        [
+            (
+                "output",
+                {
+                    "parts": [
+                        {
+                            "type": "traceback",
+                            "text": 'Traceback (most recent call last):\n'
+                                    f'  File "{default_filename()}", line 1, in <module>\n'
+                                    '    nonexistent\n'
+                                    "NameError: name 'nonexistent' is not defined\n",
+                        }
+                    ]
+                },
+            )
+        ],
+        id="runtime_error",
+    ),
+    pytest.param(
+        "input('some_prompt'); print('after')",
+        [
+            (
+                "output",
+                {
+                    "parts": [
+                        {"type": "input_prompt", "text": "some_prompt"},
+                    ]
+                },
+            ),
+            (
+                "input",
+                {"prompt": "some_prompt"},
+            ),
+            (
+                "output",
+                {
+                    "parts": [
+                        {"type": "input", "text": "input: 2\n"},
+                        {"type": "stdout", "text": "after"},
+                    ]
+                },
+            ),
+            (
+                "output",
+                {
+                    "parts": [
+                        {"type": "stdout", "text": "\n"},
+                    ]
+                },
+            ),
+        ],
+        id="simple_input",
+    ),
+]
+
+
+@pytest.mark.parametrize("source_code,expected_events", CASES)
+def test_cases(source_code, expected_events):
+    # The second run goes through the compile cache, e.g. for the cached SyntaxError
+    for _ in range(2):
+        check_simple(source_code, expected_events)
 
 
 def test_stdout_bytes():
@@ -108,13 +222,13 @@ def test_stdout_write_non_str():
                 },
             ),
         ],
-        runner=NoTracebackRunner(callback=default_callback),
+        runner=NoTracebackRunner(),
     )
 
 
 def test_stdout_attrs():
     check_simple(
-        "import sys; print(sys.stdout.encoding, callable(sys.stdout.isatty))",
+        "import sys; print(sys.stdout.encoding, callable(sys.stdout.isatty), sys.stderr.name)",
         [
             (
                 "output",
@@ -122,7 +236,7 @@ def test_stdout_attrs():
                     "parts": [
                         {
                             "type": "stdout",
-                            "text": "utf-8 True\n",
+                            "text": "utf-8 True <stderr>\n",
                         },
                     ],
                 },
@@ -131,149 +245,141 @@ def test_stdout_attrs():
     )
 
 
-def test_mixed_output():
-    source = dedent(
-        """
-        import sys
-        
-        print(1)
-        print(2)
-        
-        print(3, file=sys.stderr)
-        print(4, file=sys.stderr)
-        
-        print(5)
-        print(6)
-        
-        print(7, file=sys.stderr)
-        print(8, file=sys.stderr)
-        
-        1/0
-        """
+def test_copy_stdout():
+    check_simple(
+        "import copy, sys; copy.copy(sys.stdout).write('hi\\n')",
+        EXPECTED_PRINT_HI,
     )
+
+
+def test_writelines():
     check_simple(
-        source,
+        "import sys; sys.stdout.writelines(['a', b'b', '\\n']); sys.stderr.writelines([])",
         [
             (
                 "output",
                 {
                     "parts": [
-                        {"type": "stdout", "text": "1\n2\n"},
-                        {"type": "stderr", "text": "3"},
-                    ]
+                        {
+                            "type": "stdout",
+                            "text": "ab\n",
+                        },
+                    ],
                 },
             ),
+        ],
+    )
+
+
+def test_custom_put():
+    class UpperOutputBuffer(OutputBuffer):
+        def put(self, output_type, text, **extra):
+            super().put(output_type, text.upper(), **extra)
+
+    class UpperRunner(MyRunner):
+        OutputBufferClass = UpperOutputBuffer
+
+    check_simple(
+        "import sys; print('abc', 'def'); sys.stdout.writelines(['ghi\\n'])",
+        [
             (
                 "output",
                 {
                     "parts": [
-                        {"type": "stderr", "text": "\n4\n"},
-                        {"type": "stdout", "text": "5"},
-                    ]
+                        {"type": "stdout", "text": "ABC DEF\nGHI\n"},
+                    ],
                 },
             ),
+        ],
+        runner=UpperRunner(),
+    )
+
+
+def test_custom_should_flush():
+    class FewOutputBuffer(OutputBuffer):
+        def should_flush(self):
+            return len(self.parts) > 2
+
+    class FewRunner(MyRunner):
+        OutputBufferClass = FewOutputBuffer
+
+    check_simple(
+        "import sys; print(1); print(2, file=sys.stderr); print(3)",
+        [
             (
                 "output",
                 {
                     "parts": [
-                        {"type": "stdout", "text": "\n6\n"},
-                        {"type": "stderr", "text": "7"},
-                    ]
+                        {"type": "stdout", "text": "1\n"},
+                        {"type": "stderr", "text": "2\n"},
+                        {"type": "stdout", "text": "3"},
+                    ],
                 },
             ),
             (
                 "output",
                 {
                     "parts": [
-                        {
-                            "type": "stderr",
-                            "text": "\n8\n",
-                        },
-                        {
-                            "type": "traceback",
-                            "text": 'Traceback (most recent call last):\n'
-                                    f'  File "{default_filename()}", line 16, in <module>\n'
-                                    '    1/0\n'
-                                    'ZeroDivisionError: division by zero\n',
-                        },
-                    ]
+                        {"type": "stdout", "text": "\n"},
+                    ],
                 },
             ),
         ],
+        runner=FewRunner(),
     )
 
 
-def test_syntax_error():
-    filename = default_filename()
-    text = (
-        f'  File "{filename}", line 1\n'
-        "    a b\n"
-        "      ^\n"
-        "SyntaxError: invalid syntax\n"
-    )
-
+def test_fresh_std_streams():
+    runner = MyRunner()
+    check_simple("import sys; sys.stdout.write = lambda s: None; print(1)", [], runner=runner)
     check_simple(
-        "a b",
-        [
-            (
-                "output",
-                {
-                    "parts": [
-                        {
-                            "type": "syntax_error",
-                            "text": text,
-                        }
-                    ]
-                },
-            )
-        ],
+        "print(2)",
+        [("output", {"parts": [{"type": "stdout", "text": "2\n"}]})],
+        runner=runner,
     )
 
 
-def test_runtime_error():
+def test_edit_parts():
+    class NoStderrOutputBuffer(OutputBuffer):
+        def should_flush(self):
+            self.parts[:] = [part for part in self.parts if part["type"] != "stderr"]
+            if self.parts:
+                self.parts[-1]["text"] = self.parts[-1]["text"].replace("1", "one")
+            return super().should_flush()
+
+    class NoStderrRunner(MyRunner):
+        OutputBufferClass = NoStderrOutputBuffer
+
     check_simple(
-        "nonexistent",
+        "import sys; print(1); print(2, file=sys.stderr); print(3)",
         [
             (
                 "output",
                 {
                     "parts": [
-                        {
-                            "type": "traceback",
-                            "text": 'Traceback (most recent call last):\n'
-                                    f'  File "{default_filename()}", line 1, in <module>\n'
-                                    '    nonexistent\n'
-                                    "NameError: name 'nonexistent' is not defined\n",
-                        }
-                    ]
+                        {"type": "stdout", "text": "one\n3\n"},
+                    ],
                 },
-            )
+            ),
         ],
+        runner=NoStderrRunner(),
     )
 
 
-def test_simple_input():
+def test_iter_stdin():
     check_simple(
-        "input('some_prompt'); print('after')",
+        "import sys; print(next(iter(sys.stdin))); print(sys.stdin.close.__name__)",
         [
-            (
-                "output",
-                {
-                    "parts": [
-                        {"type": "input_prompt", "text": "some_prompt"},
-                    ]
-                },
-            ),
             (
                 "input",
-                {"prompt": "some_prompt"},
+                {"prompt": ""},
             ),
             (
                 "output",
                 {
                     "parts": [
-                        {"type": "input", "text": "input: 2\n"},
-                        {"type": "stdout", "text": "after"},
+                        {"text": "input: 1\n", "type": "input"},
+                        {"text": "input: 1\n", "type": "stdout"},
                     ]
                 },
             ),
@@ -281,7 +387,7 @@ def test_simple_input():
                 "output",
                 {
                     "parts": [
-                        {"type": "stdout", "text": "\n"},
+                        {"text": "\nclose\n", "type": "stdout"},
                     ]
                 },
             ),
@@ -289,9 +395,9 @@ def test_simple_input():
     )
 
 
-def test_iter_stdin():
+def test_readline_size():
     check_simple(
-        "import sys; print(next(iter(sys.stdin))); print(sys.stdin.close.__name__)",
+        "import sys; print([sys.stdin.readline(3), sys.stdin.readline(3), sys.stdin.readline(30), sys.stdin.readline(0)])",
         [
             (
                 "input",
@@ -302,7 +408,7 @@ def test_iter_stdin():
                 {
                     "parts": [
                         {"text": "input: 1\n", "type": "input"},
-                        {"text": "input: 1\n", "type": "stdout"},
+                        {"text": "['inp', 'ut:', ' 1\\n', '']", "type": "stdout"},
                     ]
                 },
             ),
@@ -310,7 +416,7 @@ def test_iter_stdin():
                 "output",
                 {
                     "parts": [
-                        {"text": "\nclose\n", "type": "stdout"},
+                        {"text": "\n", "type": "stdout"},
                     ]
                 },
             ),
@@ -319,14 +425,18 @@ def test_iter_stdin():
 
 
 def test_non_str_input():
-    def callback(event_type, data):
-        if event_type == "input":
-            return
-        return default_callback(event_type, data)
+    class Collector(EventCollector):
+        __slots__ = ()
+
+        def callback(self, event_type, data):
+            if event_type == "input":
+                return
+            return super().callback(event_type, data)
 
     check_simple(
         "input()",
-        runner=NoTracebackRunner(callback=callback),
+        runner=NoTracebackRunner(),
+        collector=Collector(),
         expected_events=[
             (
                 "output",
@@ -359,17 +469,21 @@ def test_custom_non_str_input():
         def non_str_input(self, value):
             print(repr(value))
 
-    def callback(event_type, data):
-        if event_type == "input":
-            return 123
-        return default_callback(event_type, data)
+    class Collector(EventCollector):
+        __slots__ = ()
+
+        def callback(self, event_type, data):
+            if event_type == "input":
+                return 123
+            return super().callback(event_type, data)
 
-    runner = Runner(callback=callback)
+    runner = Runner()
     assert runner.line == ""
 
     check_simple(
         "input()",
         runner=runner,
+        collector=Collector(),
         expected_events=[
             (
                 "output",
@@ -397,16 +511,7 @@ def test_custom_non_str_input():
 def test_single():
     check_simple(
         "1 + 2",
-        [
-            (
-                "output",
-                {
-                    "parts": [
-                        {"type": "stdout", "text": "3\n"},
-                    ],
-                },
-            ),
-        ],
+        EXPECTED_PRINT_3,
         mode="single",
     )
 
@@ -433,29 +538,51 @@ def test_eval():
         mode="eval",
     )
 
+    assert None is check_simple(
+        "print(3)",
+        EXPECTED_PRINT_3,
+        mode="eval",
+    )
+
 
 def test_empty():
     for mode in ["single", "eval", "exec"]:
         for source in ["", "#", "#foo", "#foo\n#bar\n", "\n", " "]:
             check_simple(source, [], mode=mode)
+        for source in ["# café", "\f#foo\r\n\t#bar"]:
+            check_simple(source, [], mode=mode)
+
+
+def test_empty_invalid():
+    # Characters that str.strip() treats as whitespace but Python doesn't
+    for mode in ["single", "eval", "exec"]:
+        for source in ["\xa0", "# a\n\xa0\n", "\x0b", "\u2028", "#\0"]:
+            collector = EventCollector()
+            runner = MyRunner(callback=collector.callback)
+            runner.run(source, mode=mode)
+            [(event_type, data)] = collector.events
+            assert event_type == "output"
+            [part] = data["parts"]
+            assert part["type"] == "syntax_error"
+
+
+FLUSH_DIRECT_SRC = """
+import sys
+
+print(1)
+print(2)
+
+sys.stdout.flush()
+sys.stdout.flush()
+
+print(3)
+print(4)
+"""
 
 
 def test_flush_direct():
     check_simple(
-        dedent(
-            """
-            import sys
-            
-            print(1)
-            print(2)
-            
-            sys.stdout.flush()
-            sys.stdout.flush()
-            
-            print(3)
-            print(4)
-            """
-        ),
+        FLUSH_DIRECT_SRC,
         [
             ("output", {"parts": [{"type": "stdout", "text": "1\n2\n"}]}),
             ("output", {"parts": [{"type": "stdout", "text": "3\n4\n"}]}),
@@ -463,21 +590,29 @@ def test_flush_direct():
     )
 
 
-def test_flush_time():
-    check_simple(
-        dedent(
-            """
-            import time
+FLUSH_TIME_SRC = """
+print(1)
+print(2)
 
-            print(1)
-            print(2)
+advance_clock(0.11)
 
-            time.sleep(0.11)
+print(3)
+print(4)
+"""
 
-            print(3)
-            print(4)
-            """
-        ),
+
+def test_flush_time(monkeypatch):
+    # A fake clock that the program advances instead of really sleeping
+    now = [0.0]
+
+    def advance_clock(seconds):
+        now[0] += seconds
+
+    monkeypatch.setattr(output, "time", SimpleNamespace(monotonic=lambda: now[0]))
+    monkeypatch.setattr(builtins, "advance_clock", advance_clock, raising=False)
+
+    check_simple(
+        FLUSH_TIME_SRC,
         [
             ("output", {"parts": [{"type": "stdout", "text": "1\n2\n3"}]}),
             ("output", {"parts": [{"type": "stdout", "text": "\n4\n"}]}),
@@ -486,40 +621,215 @@ def test_flush_time():
     )
 
 
+FLUSH_BIG_OUTPUT_SRC = """
+import sys
+
+# Each write reaches OutputBuffer.flush_length exactly
+for i in range(6):
+    sys.stdout.write("9\\n" * 500)
+"""
+
+
 def test_flush_big_output():
     check_simple(
-        dedent(
-            """
-            for i in range(3000):
-                print(9)
-            """
-        ),
+        FLUSH_BIG_OUTPUT_SRC,
         [
             ("output", {"parts": [{"type": "stdout", "text": "9\n" * 500}]}),
         ] * 6,
     )
 
 
+FLUSH_SMALL_WRITES_SRC = """
+import sys
+
+for i in range(2000):
+    sys.stdout.write("9")
+"""
+
+
+def test_flush_small_writes():
+    # Many small writes accumulate in one part until flush_length is reached
+    check_simple(
+        FLUSH_SMALL_WRITES_SRC,
+        [
+            ("output", {"parts": [{"type": "stdout", "text": "9" * 1000}]}),
+        ] * 2,
+    )
+
+
+def test_source_file():
+    runner1 = MyRunner()
+    runner2 = MyRunner()
+    for runner, source in [(runner1, "x = 1"), (runner2, "x = 2"), (runner1, "x = 1")]:
+        check_simple(source, [], runner=runner)
+        with open(default_filename()) as f:
+            assert f.read() == source
+
+    # The file is rewritten if something else changed it, even if the source is the same
+    source = "x = 1\nnonexistent"
+    expected = [
+        (
+            "output",
+            {
+                "parts": [
+                    {
+                        "type": "traceback",
+                        "text": 'Traceback (most recent call last):\n'
+                                f'  File "{default_filename()}", line 2, in <module>\n'
+                                '    nonexistent\n'
+                                "NameError: name 'nonexistent' is not defined\n",
+                    },
+                ],
+            },
+        ),
+    ]
+    check_simple(source, expected, runner=runner1)
+    with open(default_filename(), "w") as f:
+        f.write("garbage\ngarbage\n")
+    check_simple(source, expected, runner=runner1)
+    with open(default_filename()) as f:
+        assert f.read() == source
+
+
+def test_set_filename_after_chdir(monkeypatch, tmp_path):
+    runner = MyRunner()
+    assert runner.filename == default_filename()
+    monkeypatch.chdir(tmp_path)
+    runner.set_filename("my_program.py")
+    assert runner.filename == default_filename() == os.path.normcase(str(tmp_path / "my_program.py"))
+
+
+def test_linecache():
+    runner = MyRunner()
+    check_simple("x = 1", [], runner=runner)
+    entry = linecache.cache[runner.filename]
+    check_simple("x = 1", [], runner=runner)
+    assert linecache.cache[runner.filename] is entry
+
+    linecache.clearcache()
+    check_simple("x = 1", [], runner=runner)
+    assert linecache.getline(runner.filename, 1) == "x = 1\n"
+
+    # The entry read from the file is kept while the source is unchanged
+    entry = linecache.cache[runner.filename]
+    assert len(entry) == 4
+    check_simple("x = 1", [], runner=runner)
+    assert linecache.cache[runner.filename] is entry
+
+    check_simple("x = 2", [], runner=runner)
+    assert linecache.getline(runner.filename, 1) == "x = 2\n"
+
+
+def test_linecache_without_file():
+    filename = os.path.join(os.path.dirname(default_filename()), "nonexistent_dir", "my_program.py")
+    source = "import linecache; print(repr(linecache.getline(__file__, 1)))"
+    check_simple(
+        source,
+        [
+            (
+                "output",
+                {
+                    "parts": [
+                        {"type": "stdout", "text": repr(source + "\n") + "\n"},
+                    ],
+                },
+            ),
+        ],
+        runner=MyRunner(filename=filename),
+    )
+
+
+def test_compile_cache():
+    runner = MyRunner()
+    code_obj = runner.pre_run("x = 1")
+    assert runner.pre_run("x = 1") is code_obj
+    assert MyRunner().pre_run("x = 1") is code_obj
+    assert runner.pre_run("x = 1", mode="single") is not code_obj
+    assert runner.pre_run("x = 1", top_level_await=True) is not code_obj
+
+
+def test_syntax_error_not_shared():
+    class Runner(NoTracebackRunner):
+        def serialize_syntax_error(self, exc):
+            exc.msg += "!"
+            return super().serialize_syntax_error(exc)
+
+    expected = [
+        (
+            "output",
+            {
+                "parts": [
+                    {
+                        "type": "syntax_error",
+                        "text": f'  File "{default_filename()}", line 1\n'
+                                "    a b\n"
+                                "      ^\n"
+                                "SyntaxError: invalid syntax!\n",
+                    },
+                ],
+            },
+        ),
+    ]
+    for _ in range(2):
+        check_simple("a b", expected, runner=Runner())
+
+
+BASE_LOCALS = MappingProxyType(
+    dict(
+        (
+            ("__name__", "__main__"),
+            ("__doc__", None),
+            ("__package__", None),
+            ("__loader__", None),
+            ("__spec__", None),
+            ("__file__", default_filename()),
+            ("__builtins__", builtins.__dict__),
+        )
+    )
+)
+EXPECTED_LOCALS_X = {**BASE_LOCALS, "x": 1}
+EXPECTED_LOCALS_Y = {**BASE_LOCALS, "y": 2}
+EXPECTED_LOCALS_YZ = {**EXPECTED_LOCALS_Y, "z": 3}
+
+
 def test_console_locals():
-    runner = MyRunner(callback=default_callback)
-    base_locals = {
-        "__name__": "__main__",
-        "__doc__": None,
-        "__package__": None,
-        "__loader__": None,
-        "__spec__": None,
-        "__file__": default_filename(),
-        "__builtins__": builtins.__dict__,
-    }
+    runner = MyRunner()
 
     check_simple("x = 1", [], runner=runner)
-    assert runner.console.locals == {**base_locals, "x": 1}
+    assert runner.globals_dict == EXPECTED_LOCALS_X
+    module = sys.modules["__main__"]
+    assert module.__dict__ is runner.globals_dict
 
     check_simple("y = 2", [], runner=runner)
-    assert runner.console.locals == {**base_locals, "y": 2}
+    assert runner.globals_dict == EXPECTED_LOCALS_Y
+    assert sys.modules["__main__"] is not module
+    assert module.__dict__ == EXPECTED_LOCALS_X
 
     check_simple("z = 3", [], runner=runner, mode="single")
-    assert runner.console.locals == {**base_locals, "y": 2, "z": 3}
+    assert runner.globals_dict == EXPECTED_LOCALS_YZ
+    assert runner.console.locals is runner.globals_dict
+
+    # Assigning console.locals like older code did changes where code runs
+    runner.console.locals = {"__builtins__": builtins.__dict__, "w": 4}
+    assert runner.run("w + 1", mode="eval") == 5
+    runner.reset()
+    assert runner.console.locals is runner.globals_dict
+    assert runner.globals_dict == BASE_LOCALS
+
+    # So does assigning a new console
+    runner.console = InteractiveConsole({"__builtins__": builtins.__dict__, "v": 6})
+    assert runner.run("v + 1", mode="eval") == 7
+    runner.reset()
+    assert runner.console.locals is runner.globals_dict
+    assert runner.globals_dict == BASE_LOCALS
+
+
+def test_old_globals_survive_reset():
+    runner = MyRunner()
+    check_simple("x = 1", [], runner=runner)
+    f = check_simple("lambda: x", [], runner=runner, mode="eval")
+    check_simple("y = 2", [], runner=runner)
+    assert f() == 1
 
 
 def test_await_syntax_error():
@@ -568,66 +878,42 @@ def test_sleep():
                 {"seconds": 123},
             ),
         ],
-        runner=SleepRunner(callback=default_callback),
+        runner=SleepRunner(),
     )
 
 
+AWAIT_SRC = """
+async def foo():
+    print('hi')
+
+await foo()
+"""
+
+
 def test_await():
-    global events
-    events = []
-
-    runner = MyRunner(callback=default_callback)
-    result = runner.run_async(
-        dedent(
-            """
-    async def foo():
-        print('hi')
-    
-    await foo()
-            """
-        )
-    )
-    assert events == []
-    asyncio.run(result, debug=True)
-    assert events == [
-        (
-            "output",
-            {
-                "parts": [
-                    {"type": "stdout", "text": "hi\n"},
-                ],
-            },
-        ),
-    ]
+    collector = EventCollector()
+    runner = MyRunner(callback=collector.callback)
+    result = runner.run_async(AWAIT_SRC)
+    assert collector.events == []
+    asyncio.run(result)
+    assert collector.events == EXPECTED_PRINT_HI
+
+
+NO_AWAIT_SRC = """
+def foo():
+    print('hi')
+
+foo()
+"""
 
 
 def test_async_without_await():
-    global events
-    events = []
-
-    runner = MyRunner(callback=default_callback)
-    result = runner.run_async(
-        dedent(
-            """
-    def foo():
-        print('hi')
-
-    foo()
-            """
-        )
-    )
-    assert events == []
-    asyncio.run(result, debug=True)
-    assert events == [
-        (
-            "output",
-            {
-                "parts": [
-                    {"type": "stdout", "text": "hi\n"},
-                ],
-            },
-        ),
-    ]
+    collector = EventCollector()
+    runner = MyRunner(callback=collector.callback)
+    result = runner.run_async(NO_AWAIT_SRC)
+    assert collector.events == []
+    asyncio.run(result)
+    assert collector.events == EXPECTED_PRINT_HI
 
 
 def test_invalid_sleep():
@@ -642,24 +928,71 @@ def test_invalid_sleep():
                     runner.sleep(arg)
                 raise
 
+
+SNOOP_SRC = """
+def double(x):
+    return 2*x
+
+double(5)
+"""
+
+
 def test_snoop():
     filename = default_filename()
-    code = dedent(
-        """
-    def double(x):
-        return 2*x
-
-    double(5)
-        """)
-    check_simple(code, [
-        ('output', {'parts': [{'type': 'snoop', 'text': (
-            '    2 | def double(x):\n'
-            '    5 | double(5)\n'  
-           f'     >>> Call to double in File "{filename}", line 2\n'
-            '     ...... x = 5\n'
-            '        2 | def double(x):\n'
-            '        3 |     return 2*x\n'
-            '     <<< Return value from double: 10\n'
-            '    5 | double(5)\n'
-            )}]})
-        ], mode="snoop")
+    runner = MyRunner()
+    # Repeating a config reuses the cached snoop.Config,
+    # and configs with unhashable values work without caching
+    for snoop_config in [None, None, {"watch_extras": []}]:
+        check_simple(SNOOP_SRC, [
+            ('output', {'parts': [{'type': 'snoop', 'text': (
+                '    2 | def double(x):\n'
+                '    5 | double(5)\n'  
+               f'     >>> Call to double in File "{filename}", line 2\n'
+                '     ...... x = 5\n'
+                '        2 | def double(x):\n'
+                '        3 |     return 2*x\n'
+                '     <<< Return value from double: 10\n'
+                '    5 | double(5)\n'
+                )}]})
+            ], mode="snoop", runner=runner, snoop_config=snoop_config)
+
+
+SNOOP_CLASS_SRC = """
+from sys import version as v
+
+class A:
+    x = 1
+
+y = A.x
+"""
+
+
+def test_snoop_class():
+    collector = EventCollector()
+    runner = MyRunner(callback=collector.callback)
+    runner.run(SNOOP_CLASS_SRC, mode="snoop")
+    [(event_type, data)] = collector.events
+    assert event_type == "output"
+    [part] = data["parts"]
+    assert part["type"] == "snoop"
+    text = part["text"]
+    assert " ...... A = <class '__main__.A'>\n" in text
+    assert " ...... y = 1\n" in text
+    # Names that the compiler adds or that are only bound by imports aren't shown
+    for name in ["__name__", "__module__", "__qualname__", "v"]:
+        assert f" {name} = " not in text
+
+
+def test_snoop_out_file_overwrite(tmp_path):
+    path = tmp_path / "snoop.log"
+    runner = MyRunner()
+    for i in range(3):
+        check_simple(
+            f"x = {i}",
+            [],
+            mode="snoop",
+            runner=runner,
+            snoop_config={"out": str(path), "overwrite": True},
+        )
+    # Each run overwrites the file as a new snoop.Config would
+    assert path.read_text() == "    1 | x = 2\n"